@@ -1 +1,2 @@
-MRC_MRCS_EXT = [".mrc", ".mrcs"]
+MRC_MRCS_EXT = (".mrc", ".mrcs")
+MD_FILE_FORMATS = ("yaml", "json")
@@ -1,19 +1,47 @@
-import math
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
 from pathlib import Path
-from typing import List, Tuple, Dict
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
 import yaml
 from cets_data_model.models.models import CTFMetadata
 from imod.contants import MRC_MRCS_EXT
 from imod.utils.utils import (
     get_ts_no_imgs,
-    standarize_defocus,
+    standarize_defocus_batch,
     load_md_list_yaml,
     validate_file,
     validate_new_file,
+    YamlDumper,
+    yaml_float,
 )
 
 
+# Content of the IMOD defocus file for each supported flag: description of the CTF
+# estimation, expected number of columns and the (column, scale) pairs of the defocus
+# u, defocus v, defocus angle and phase shift, or None if the parameter is not
+# contained in the file. Defocus values are converted from nm to angstroms.
+CTF_FLAG_COLUMNS: Dict[
+    int, Tuple[str, int, Tuple[Optional[Tuple[int, float]], ...]]
+] = {
+    0: ("with no astigmatism", 5, ((4, 10.0), None, None, None)),
+    1: ("with astigmatism", 7, ((4, 10.0), (5, 10.0), (6, 1.0), None)),
+    4: ("with defocus and phase shift", 6, ((4, 10.0), None, None, (5, 1.0))),
+    5: (
+        "with astigmatism and phase shift",
+        8,
+        ((4, 10.0), (5, 10.0), (6, 1.0), (7, 1.0)),
+    ),
+    37: (
+        "with astigmatism, phase shift and cut-on frequency",
+        9,
+        ((4, 10.0), (5, 10.0), (6, 1.0), (7, 1.0)),
+    ),
+}
+
+
 class ImodCtfSeries:
     def __init__(self, ts_file_name: Path, defocus_file: Path) -> None:
         self.ts_file_name = validate_file(ts_file_name, "ts_file_name", MRC_MRCS_EXT)
@@ -49,166 +77,121 @@ class ImodCtfSeries:
                 f"The number of data sections [{n_data_sec}] must be the same "
                 f"as the number of angles [{n_angles}] provided."
             )
-        with open(defocus_file, "w") as f:
-            lines = ["1\t0\t0.0\t0.0\t0.0\t3\n"]
-            for i, ctf_md_dict in enumerate(md_list):
-                ind = i + 1  # Indices in IMOD start in 1
-                tilt_angle = tilt_angle_list[i]
-                newLine = "%i\t%i\t%.2f\t%.2f\t%.1f\t%.1f\t%.2f\n" % (
-                    ind,
-                    ind,
-                    tilt_angle,
-                    tilt_angle,
-                    ctf_md_dict["defocus_u"] / 10,  # Defocus value in Imod is in nm
-                    ctf_md_dict["defocus_v"] / 10,
-                    ctf_md_dict["defocus_angle"],
-                )
-
-                lines.append(newLine)
-            f.writelines(lines)
+        # Columns: start and end indices (indices in IMOD start in 1), start and end
+        # tilt angles, defocus u, defocus v (defocus values in IMOD are in nm) and
+        # defocus angle
+        defocus_table = np.empty((n_data_sec, 7), dtype=np.float64)
+        defocus_table[:, 0] = defocus_table[:, 1] = np.arange(1, n_data_sec + 1)
+        defocus_table[:, 2] = defocus_table[:, 3] = tilt_angle_list
+        defocus_table[:, 4] = [ctf_md_dict["defocus_u"] for ctf_md_dict in md_list]
+        defocus_table[:, 5] = [ctf_md_dict["defocus_v"] for ctf_md_dict in md_list]
+        defocus_table[:, 6] = [ctf_md_dict["defocus_angle"] for ctf_md_dict in md_list]
+        defocus_table[:, 4:6] /= 10
+        np.savetxt(
+            defocus_file,
+            defocus_table,
+            fmt="%i\t%i\t%.2f\t%.2f\t%.1f\t%.1f\t%.2f",
+            header="1\t0\t0.0\t0.0\t0.0\t3",
+            comments="",
+        )
         print(f"defocus file successfully writen! -> {defocus_file}")
 
+    @cached_property
+    def _ctf_estimations(
+        self,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Tilt-image index and parameters of each estimation contained in the defocus
+        file. The file is parsed on first access and the result is reused by later
+        conversions."""
+        with open(self.defocus_file) as f:
+            # The flag only depends on the first two lines. They are then chained with
+            # the rest of the file, which is streamed to the table parser
+            header = [f.readline(), f.readline()]
+            flag = self._get_defocus_file_flag(header)
+            return self._load_ctf_file(chain(header, f), flag)
+
     def _parse_defocus_file(
         self, out_yaml_file: str | Path | None = None
     ) -> List[CTFMetadata]:
         """Parse tilt-series ctf estimation file."""
-        defocusFileFlag = self._get_defocus_file_flag()
-        (defocus_u_dict, defocus_v_dict, defocus_angle_dict, phase_shift_dict) = (
-            dict(),
-            dict(),
-            dict(),
-            dict(),
-        )
-
-        if defocusFileFlag == 0:
-            # Plain estimation
-            defocus_u_dict = self._load_ctf_file(defocusFileFlag)
-
-        elif defocusFileFlag == 1:
-            # Astigmatism estimation
-            defocus_u_dict, defocus_v_dict, defocus_angle_dict = self._load_ctf_file(
-                defocusFileFlag
-            )
+        # The parameters not contained in the defocus file are empty arrays
+        (
+            indices,
+            defocus_u_values,
+            defocus_v_values,
+            defocus_angle_values,
+            phase_shift_values,
+        ) = self._ctf_estimations
 
-        elif defocusFileFlag == 4:
-            # Phase-shift information
-            defocus_u_dict, phase_shift_dict = self._load_ctf_file(defocusFileFlag)
-
-        elif defocusFileFlag == 5:
-            # Astigmatism and phase shift estimation
-            defocus_u_dict, defocus_v_dict, defocus_angle_dict, phase_shift_dict = (
-                self._load_ctf_file(defocusFileFlag)
-            )
-
-        elif defocusFileFlag == 37:
-            # Astigmatism, phase shift and cut-on frequency estimation
-            defocus_u_dict, defocus_v_dict, defocus_angle_dict, phase_shift_dict = (
-                self._load_ctf_file(defocusFileFlag)
+        n_imgs = get_ts_no_imgs(self.ts_file_name)
+        # Sort the estimations by tilt-image index (keeping the file order within each
+        # tilt-image), so the estimations of tilt-image i are the contiguous slice
+        # [offsets[i], offsets[i] + counts[i]) of the sorted order
+        order = np.argsort(indices, kind="stable")
+        counts = np.bincount(indices, minlength=n_imgs + 1)
+        offsets = (np.cumsum(counts) - counts)[1 : n_imgs + 1]
+        counts = counts[1 : n_imgs + 1]
+        if not counts.all():
+            missing = (np.flatnonzero(counts == 0) + 1).tolist()
+            raise ValueError(
+                f"No CTF estimation found in {self.defocus_file} for the "
+                f"tilt-images {missing}."
             )
+        # The parameters of each tilt-image are set equal to the middle estimation of
+        # its list. If the size of the list is even, the 2 centre values are averaged
+        low = order[offsets + (counts - 1) // 2]
+        high = order[offsets + counts // 2]
+
+        # DEFOCUS INFORMATION ------------------------------------------------------------------------------------------
+        defocus_u = self._middle_values(defocus_u_values, low, high)
+        if defocus_v_values.size:
+            defocus_v = self._middle_values(defocus_v_values, low, high)
+            defocus_angle = self._middle_values(defocus_angle_values, low, high)
+        else:
+            # DefocusU and DefocusV are set at the same value
+            defocus_v = defocus_u
+            defocus_angle = np.zeros(n_imgs)
 
+        # PHASE SHIFT INFORMATION --------------------------------------------------------------------------------------
+        if phase_shift_values.size:
+            phase_shift = self._middle_values(phase_shift_values, low, high)
         else:
-            raise ValueError(
-                f"Defocus file flag {defocusFileFlag} is not supported. Only supported formats "
-                "correspond to flags 0, 1, 4, 5, and 37."
-            )
+            phase_shift = np.zeros(n_imgs)
 
-        n_imgs = get_ts_no_imgs(self.ts_file_name)
+        defocus_u, defocus_v, defocus_angle = standarize_defocus_batch(
+            defocus_u, defocus_v, defocus_angle
+        )
         ctf_md_list = []
-        for i in range(1, n_imgs + 1):
-            defocus_u_list = defocus_u_dict.get(i, [])
-            defocus_v_list = defocus_v_dict.get(i, [])
-            phase_shift_list = phase_shift_dict.get(i, [])
-            defocus_angle_list = defocus_angle_dict.get(i, [])
-            len_defocus_angle_list = len(defocus_angle_list)
-            len_phase_shift_list = len(phase_shift_list)
-
-            # DEFOCUS INFORMATION --------------------------------------------------------------------------------------
-            if defocus_u_list and defocus_v_list:
-                # Check that the three list are equally long
-                len_defocus_u_list = len(defocus_u_list)
-                if (
-                    len_defocus_u_list + len(defocus_v_list) + len_defocus_angle_list
-                ) % 3 != 0:
-                    raise Exception(
-                        "defocus_u_list, defocus_v_list and defocus_angle_list lengths must be equal."
-                    )
-
-                # DefocusU, DefocusV and DefocusAngle are set equal to the middle estimation of the list
-                middlePoint = math.trunc(len_defocus_u_list / 2)
-
-                # If the size of the defocus list is even, mean the 2 centre values
-                if len_defocus_u_list % 2 == 0:
-                    defocus_u = (
-                        defocus_u_list[middlePoint] + defocus_u_list[middlePoint - 1]
-                    ) / 2
-                    defocus_v = (
-                        defocus_v_list[middlePoint] + defocus_v_list[middlePoint - 1]
-                    ) / 2
-                    defocus_angle = (
-                        defocus_angle_list[middlePoint]
-                        + defocus_angle_list[middlePoint - 1]
-                    ) / 2
-                else:
-                    defocus_u = defocus_u_list[middlePoint]
-                    defocus_v = defocus_v_list[middlePoint]
-                    defocus_angle = defocus_angle_list[middlePoint]
-
-            else:
-                defocus_list = defocus_u_list if defocus_u_list else defocus_v_list
-                len_defocus_list = len(defocus_list)
-                defocus_angle = 0
-                # DefocusU and DefocusV are set at the same value, equal to the middle
-                # estimation of the list
-                middle_point = math.trunc(len_defocus_list / 2)
-                # If the size of the defocus list is even, mean the 2 centre values
-                if len_defocus_list % 2 == 0:
-                    defocus_u = (
-                        defocus_list[middle_point] + defocus_list[middle_point - 1]
-                    ) / 2
-                else:
-                    # The size of defocus estimation is odd, get the centre value
-                    defocus_u = defocus_list[middle_point]
-                defocus_v = defocus_u
-
-            # PHASE SHIFT INFORMATION ----------------------------------------------------------------------------------
-            # Check that all the lists are equally long
-            phase_shift = 0
-            if phase_shift_list:
-                if (len(defocus_u_list) + len_phase_shift_list) % 2 != 0:
-                    raise Exception(
-                        f"phase_shift_list length [{len_phase_shift_list}] must be equal to "
-                        f"defocus_u_list [{len(defocus_u_list)}] lengths."
-                    )
-
-                # PhaseShift is set equal to the middle estimation of the list
-                middlePoint = math.trunc(len(phase_shift_list) / 2)
-
-                # If the size of the phase shift list is even, mean the 2 centre values
-                if len(phase_shift_list) % 2 == 0:
-                    phase_shift = (
-                        phase_shift_list[middlePoint]
-                        + phase_shift_list[middlePoint - 1]
-                    ) / 2
-                else:
-                    # If the size of phase shift list estimation is odd, get the centre value
-                    phase_shift = phase_shift_list[middlePoint]
-
-            defocus_u, defocus_v, defocus_angle = standarize_defocus(
-                defocus_u, defocus_v, defocus_angle
-            )
+        for du, dv, da, ps in zip(
+            defocus_u.tolist(),
+            defocus_v.tolist(),
+            defocus_angle.tolist(),
+            phase_shift.tolist(),
+        ):
+            # The values are plain Python floats computed from the parsed table, so the
+            # Pydantic validation is skipped
             ctf_md_list.append(
-                CTFMetadata(
-                    defocus_u=defocus_u,
-                    defocus_v=defocus_v,
-                    defocus_angle=defocus_angle,
-                    phase_shift=phase_shift,
+                CTFMetadata.model_construct(
+                    defocus_u=du,
+                    defocus_v=dv,
+                    defocus_angle=da,
+                    phase_shift=ps,
                 )
             )
         # Write the output yaml file if requested
         self._write_ctf_yaml(ctf_md_list, out_yaml_file)
         return ctf_md_list
 
-    def _get_defocus_file_flag(self) -> int:
+    @staticmethod
+    def _middle_values(
+        values: np.ndarray, low: np.ndarray, high: np.ndarray
+    ) -> np.ndarray:
+        """Returns, for each tilt-image, the mean of its two central estimations. Both
+        positions are the same when the number of estimations is odd."""
+        return (values[low] + values[high]) / 2
+
+    @staticmethod
+    def _get_defocus_file_flag(header: List[str]) -> int:
         """This method returns the flag that indicate the
         information contained in an IMOD defocus file. The flag
         value "is the sum of:
@@ -224,277 +207,121 @@ class ImodCtfSeries:
 
          (from https://bio3d.colorado.edu/imod/doc/man/ctfphaseflip.html)."""
 
-        with open(self.defocus_file) as f:
-            lines = f.readlines()
         # File contains only defocus information (no astigmatism, no phase shift,
-        # no cut-on frequency)
-        if len(lines) == 1:
+        # no cut-on frequency). An empty second line means the file has only one line
+        first_line, second_line = header
+        if not second_line:
             return 0
-        elif len(lines[1].split()) == 5:
+        elif len(second_line.split()) == 5:
             return 0
         # File contains more information apart
-        return int(lines[0].split()[0])
-
-    def _load_ctf_file(self, flag: int):
-        """This method takes an IMOD-based file path containing the
-        information associated to a CTF estimation and produces a set
-        of dictionaries containing the information of each parameter
-        for each tilt-image belonging to the tilt-series."""
-
-        # Read info as table
-        ctf_info_imod_table = self._defocus_file_to_table()
-
-        if flag == 0:
-            # Plain estimation
-            return self._refactor_ctf_flag_0(ctf_info_imod_table)
-
-        elif flag == 1:
-            # Astigmatism estimation
-            return self._refactor_ctf_flag_1(ctf_info_imod_table)
+        return int(first_line.split()[0])
 
-        elif flag == 4:
-            # Phase-shift estimation
-            return self._refactor_ctf_flag_4(ctf_info_imod_table)
+    def _load_ctf_file(
+        self, lines: Iterable[str], flag: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """This method takes the lines of an IMOD-based file containing
+        the information associated to a CTF estimation and produces the
+        tilt-image index of each estimation and a set of arrays containing
+        the information of each parameter."""
 
-        elif flag == 5:
-            # Astigmatism and phase shift estimation
-            return self._refactor_ctf_flag_5(ctf_info_imod_table)
-
-        elif flag == 37:
-            # Astigmatism, phase shift and cut-on frequency estimation
-            return self._refactor_ctf_flag_37(ctf_info_imod_table)
-
-        else:
+        if flag not in CTF_FLAG_COLUMNS:
             raise ValueError(
-                "Defocus file flag do not supported. Only supported formats corresponding to flags 0, "
-                "1, 4, 5, and 37."
+                f"Defocus file flag {flag} is not supported. Only supported formats "
+                "correspond to flags 0, 1, 4, 5, and 37."
             )
+        # Read info as table
+        ctf_info_imod_table = self._defocus_file_to_table(lines, flag)
+        return self._refactor_ctf_table(ctf_info_imod_table, flag)
 
-    def _defocus_file_to_table(self) -> List[List[float]]:
-        """This method takes an IMOD-based ctf estimation file
-        and returns a table containing the CTF estimation
+    @staticmethod
+    def _defocus_file_to_table(lines: Iterable[str], flag: int) -> np.ndarray:
+        """This method takes the lines of an IMOD-based ctf estimation
+        file and returns a table containing the CTF estimation
         information of each tilt-image (per line) belonging to the tilt-series."""
-        defocusTable = []
-
-        with open(self.defocus_file) as f:
-            lines = f.readlines()
-
-        for index, line in enumerate(lines):
-            vector = [float(i) for i in line.split()]
-
-            if index == 0 and len(lines) == 1:
-                # CTF estimation is plain (no astigmatism, no phase shift, no cut-on frequency) and is the first line.
-                # Remove last element from the first line (it contains the mode of the estimation run). This case
-                # considers that the estimation file only has one line.
-                vector.pop()
-                defocusTable.append(vector)
-
-            elif index == 0 and len(lines[1].split()) == 5:
-                # CTF estimation is plain (no astigmatism, no phase shift, no cut-on frequency) and is the first line.
-                # Remove last element from the first line (it contains the mode of the estimation run).
-                vector.pop()
-                defocusTable.append(vector)
-
-            elif index == 0 and len(lines[1].split()) != 5:
-                # CTF estimation is not plain and is the first line.
-                # Do not add this line to the table. Only contains flag and format info.
-                pass
-
-            else:
-                # Any posterior line that is not the first one is added to the table .
-                defocusTable.append(vector)
-
-        return defocusTable
+        if flag == 0:
+            # CTF estimation is plain (no astigmatism, no phase shift, no cut-on frequency).
+            # The first line contains an extra element (the mode of the estimation run),
+            # so only the first 5 columns are read.
+            return np.loadtxt(lines, dtype=np.float64, usecols=range(5), ndmin=2)
+        # CTF estimation is not plain. The first line only contains flag and format
+        # info, so it is skipped.
+        return np.loadtxt(lines, dtype=np.float64, skiprows=1, ndmin=2)
 
     @staticmethod
-    def _append_to_dict(dictionary: dict, index: int, value: float) -> None:
-        # Python Dictionary setdefault() returns the value of a key (if the key is in dictionary).
-        # Else, it inserts a key with the default value to the dictionary.
-        dictionary.setdefault(index, []).append(value)
-
-    def _refactor_ctf_flag_0(
-        self, ctf_info_imod_table: List[List[float]]
-    ) -> dict[int, list[float]]:
-        """This method takes a table containing the information of
-        an IMOD-based CTF estimation containing only defocus
-        information (5 columns) and produces a dictionary for clearer
-        and easier management. Flag 0 (Plain estimation)."""
-
-        if len(ctf_info_imod_table[0]) != 5:
-            raise Exception(
-                "Misleading file format, CTF estimation with no astigmatism should be 5 columns long"
-            )
-
-        defocus_u_dict: Dict[int, List[float]] = {}
-
-        for element in ctf_info_imod_table:
-            start, end = int(element[0]), int(element[1])
-            defocus = float(element[4]) * 10
-
-            for index in range(start, end + 1):
-                self._append_to_dict(defocus_u_dict, index, defocus)
-
-        return defocus_u_dict
+    def _expand_ranges(
+        ctf_info_imod_table: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Each row of the table applies to the tilt-images in the range [start, end]
+        (columns 0 and 1). This method returns the tilt-image index of each expanded
+        element and the number of tilt-images covered by each row, so the row values
+        can be expanded with np.repeat. Rows with end < start cover no tilt-image,
+        so they are skipped."""
+        starts, ends = ctf_info_imod_table[:, :2].astype(np.int64).T
+        counts = np.maximum(ends - starts + 1, 0)
+        offsets = np.cumsum(counts) - counts
+        indices = np.repeat(starts, counts) + (
+            np.arange(counts.sum()) - np.repeat(offsets, counts)
+        )
+        return indices, counts
 
-    def _refactor_ctf_flag_1(
-        self, ctf_info_imod_table: List[List[float]]
-    ) -> Tuple[dict[int, list[float]], dict[int, list[float]], dict[int, list[float]]]:
+    def _refactor_ctf_table(
+        self, ctf_info_imod_table: np.ndarray, flag: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         """This method takes a table containing the information of an
-        IMOD-based CTF estimation containing defocus and
-        astigmatism information (7 columns) and produces a set
-        of dictionaries for clearer and easier management. Flag 1
-        (Astigmatism estimation)."""
-
-        if len(ctf_info_imod_table[0]) != 7:
-            raise Exception(
-                "Misleading file format, CTF estimation "
-                "with astigmatism should be 7 columns long"
-            )
-        defocus_u_dict: Dict[int, List[float]] = {}
-        defocus_v_dict: Dict[int, List[float]] = {}
-        defocus_angle_dict: Dict[int, List[float]] = {}
-
-        for element in ctf_info_imod_table:
-            start, end = int(element[0]), int(element[1])
-            defocus_u = float(element[4]) * 10  # From nm to angstroms
-            defocus_v = float(element[5]) * 10  # From nm to angstroms
-            defocus_angle = float(element[6])
-
-            # Segregate information from range
-            for index in range(start, end + 1):
-                self._append_to_dict(defocus_u_dict, index, defocus_u)
-                self._append_to_dict(defocus_v_dict, index, defocus_v)
-                self._append_to_dict(defocus_angle_dict, index, defocus_angle)
-
-        return defocus_u_dict, defocus_v_dict, defocus_angle_dict
-
-    def _refactor_ctf_flag_4(
-        self, ctf_info_imod_table: List[List[float]]
-    ) -> Tuple[dict[int, list[float]], dict[int, list[float]]]:
-        """This method takes a table containing the information of
-        an IMOD-based CTF estimation containing defocus, and phase
-        shift information (6 columns) and produces a new set of
-        dictionaries for clearer and easier management. Flag 4
-        (Phase-shift estimation)."""
-
-        if len(ctf_info_imod_table[0]) != 6:
+        IMOD-based CTF estimation and produces the tilt-image index and
+        the defocus u, defocus v, defocus angle and phase shift of each
+        estimation, as given by CTF_FLAG_COLUMNS for the corresponding
+        flag. The parameters not contained in the file are returned as
+        empty arrays."""
+
+        description, n_columns, columns = CTF_FLAG_COLUMNS[flag]
+        if ctf_info_imod_table.shape[1] != n_columns:
             raise Exception(
-                "Misleading file format, CTF estimation with defocus "
-                "and phase shift should be 6 columns long"
+                f"Misleading file format, CTF estimation {description} should be "
+                f"{n_columns} columns long"
             )
 
-        defocus_u_dict: Dict[int, List[float]] = {}
-        phase_shift_dict: Dict[int, List[float]] = {}
-
-        for element in ctf_info_imod_table:
-            start, end = int(element[0]), int(element[1])
-            defocus_u = float(element[4]) * 10
-            phase_shift = float(element[5])
-
-            for index in range(start, end + 1):
-                self._append_to_dict(defocus_u_dict, index, defocus_u)
-                self._append_to_dict(phase_shift_dict, index, phase_shift)
-
-        return defocus_u_dict, phase_shift_dict
-
-    def _refactor_ctf_flag_5(
-        self, ctf_info_imod_table: List[List[float]]
-    ) -> Tuple[
-        dict[int, list[float]],
-        dict[int, list[float]],
-        dict[int, list[float]],
-        dict[int, list[float]],
-    ]:
-        """This method takes a table containing the information of
-        an IMOD-based CTF estimation containing defocus, astigmatism
-        and phase shift information (8 columns) and produces a new
-        set of dictionaries for clearer and easier management.
-        Flag 5 (Astigmatism and phase shift estimation)."""
-
-        if len(ctf_info_imod_table[0]) != 8:
-            raise Exception(
-                "Misleading file format, CTF estimation with astigmatism and phase "
-                "shift should be 8 columns long"
-            )
-
-        defocus_u_dict: Dict[int, List[float]] = {}
-        defocus_v_dict: Dict[int, List[float]] = {}
-        defocus_angle_dict: Dict[int, List[float]] = {}
-        phase_shift_dict: Dict[int, List[float]] = {}
-
-        for element in ctf_info_imod_table:
-            start, end = int(element[0]), int(element[1])
-            defocus_u = float(element[4]) * 10
-            defocus_v = float(element[5]) * 10
-            angle = float(element[6])
-            phase_shift = float(element[7])
-
-            for index in range(start, end + 1):
-                self._append_to_dict(defocus_u_dict, index, defocus_u)
-                self._append_to_dict(defocus_v_dict, index, defocus_v)
-                self._append_to_dict(defocus_angle_dict, index, angle)
-                self._append_to_dict(phase_shift_dict, index, phase_shift)
-
-        return defocus_u_dict, defocus_v_dict, defocus_angle_dict, phase_shift_dict
-
-    def _refactor_ctf_flag_37(
-        self, ctf_info_imod_table: List[List[float]]
-    ) -> Tuple[
-        dict[int, list[float]],
-        dict[int, list[float]],
-        dict[int, list[float]],
-        dict[int, list[float]],
-    ]:
-        """This method takes a table containing the information of an
-        IMOD-based CTF estimation containing defocus, astigmatism, phase
-        shift information and cut-on frequency (8 columns) and produces a
-        new set of dictionaries for clearer and easier management.
-        Flag 37 (Astigmatism, phase shift and cut-on frequency estimation)."""
-
-        if len(ctf_info_imod_table[0]) != 9:
-            raise Exception(
-                "Misleading file format, CTF estimation with astigmatism, "
-                "phase shift and cut-on frequency should be 9 columns long"
-            )
-
-        defocus_u_dict: Dict[int, List[float]] = {}
-        defocus_v_dict: Dict[int, List[float]] = {}
-        defocus_angle_dict: Dict[int, List[float]] = {}
-        phase_shift_dict: Dict[int, List[float]] = {}
-
-        for element in ctf_info_imod_table:
-            start, end = int(element[0]), int(element[1])
-            defocus_u = float(element[4]) * 10
-            defocus_v = float(element[5]) * 10
-            angle = float(element[6])
-            phase_shift = float(element[7])
-
-            for index in range(start, end + 1):
-                self._append_to_dict(defocus_u_dict, index, defocus_u)
-                self._append_to_dict(defocus_v_dict, index, defocus_v)
-                self._append_to_dict(defocus_angle_dict, index, angle)
-                self._append_to_dict(phase_shift_dict, index, phase_shift)
-
-        return (
-            defocus_u_dict,
-            defocus_v_dict,
-            defocus_angle_dict,
-            phase_shift_dict,
+        indices, counts = self._expand_ranges(ctf_info_imod_table)
+        col_indices = [column[0] for column in columns if column is not None]
+        scales = [column[1] for column in columns if column is not None]
+        # Expand all the parameters in a single pass
+        values = np.repeat(ctf_info_imod_table[:, col_indices] * scales, counts, axis=0)
+        expanded = iter(values.T)
+        empty = np.empty(0, dtype=np.float64)
+        defocus_u, defocus_v, defocus_angle, phase_shift = (
+            next(expanded) if column is not None else empty for column in columns
         )
+        return indices, defocus_u, defocus_v, defocus_angle, phase_shift
 
     @staticmethod
     def _write_ctf_yaml(
-        cets_ctf_md_list: List[CTFMetadata], yaml_file: Path | str | None
+        cets_ctf_md_list: List[CTFMetadata],
+        yaml_file: Path | str | None,
+        fast_yaml: bool = True,
     ) -> None:
         if yaml_file is None:
             print("write_yaml -> yaml_file is None. Skipping...")
             return
         try:
             yaml_file = validate_new_file(yaml_file)
-            with open(yaml_file, "a") as file:
-                for metadata in cets_ctf_md_list:
-                    metadata_dict = metadata.model_dump()
-                    yaml.dump(metadata_dict, file, sort_keys=False, explicit_start=True)
+            # One YAML document per tilt-image, all emitted in a single stream
+            with open(yaml_file, "w") as file:
+                if fast_yaml:
+                    file.write(
+                        "".join(
+                            ImodCtfSeries._ctf_md_to_yaml(metadata)
+                            for metadata in cets_ctf_md_list
+                        )
+                    )
+                else:
+                    yaml.dump_all(
+                        (metadata.model_dump() for metadata in cets_ctf_md_list),
+                        file,
+                        Dumper=YamlDumper,
+                        sort_keys=False,
+                        explicit_start=True,
+                    )
             print(f"yaml file successfully written! -> {yaml_file}")
         except Exception as e:
             print(
@@ -503,6 +330,72 @@ class ImodCtfSeries:
             )
             print(traceback.format_exc())
 
+    @staticmethod
+    def _ctf_md_to_yaml(ctf_md: CTFMetadata) -> str:
+        """Formats a CTFMetadata object as a YAML document. As its fields are plain
+        scalars, the document is composed directly, giving the same text as
+        yaml.dump. Any other field value falls back to yaml.dump."""
+        lines = ["---\n"]
+        for key in type(ctf_md).model_fields:
+            value = getattr(ctf_md, key)
+            if value is None:
+                lines.append(f"{key}: null\n")
+            elif type(value) is float:
+                lines.append(f"{key}: {yaml_float(value)}\n")
+            elif type(value) is int:
+                lines.append(f"{key}: {value}\n")
+            else:
+                return yaml.dump(
+                    ctf_md.model_dump(),
+                    Dumper=YamlDumper,
+                    sort_keys=False,
+                    explicit_start=True,
+                )
+        return "".join(lines)
+
+
+def _ctf_series_to_cets(
+    ts_file_name: Path, defocus_file: Path, out_yaml_file: str | Path | None
+) -> List[CTFMetadata]:
+    return ImodCtfSeries(ts_file_name, defocus_file).imod_to_cets(
+        out_yaml_file=out_yaml_file
+    )
+
+
+def convert_many(
+    ts_files: List[Path],
+    defocus_files: List[Path],
+    out_yaml_files: List[str | Path | None],
+    max_workers: Optional[int] = None,
+) -> List[List[CTFMetadata]]:
+    """Converts the defocus files of several tilt-series into CETS CTFMetadata
+    lists, one tilt-series per worker process.
+
+    :param ts_files: tilt-series files.
+    :type ts_files: list of pathlib.Path
+
+    :param defocus_files: IMOD defocus file of each tilt-series.
+    :type defocus_files: list of pathlib.Path
+
+    :param out_yaml_files: name of the yaml file in which the CTF metadata of each
+    tilt-series will be written, or None to skip it.
+    :type out_yaml_files: list of pathlib.Path or str or None
+
+    :param max_workers: number of worker processes. Defaults to the number of CPUs.
+    :type max_workers: int, optional
+    """
+    n_ts = len(ts_files)
+    if len(defocus_files) != n_ts or len(out_yaml_files) != n_ts:
+        raise ValueError(
+            f"The number of defocus files [{len(defocus_files)}] and output yaml "
+            f"files [{len(out_yaml_files)}] must be the same as the number of "
+            f"tilt-series [{n_ts}] provided."
+        )
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(
+            executor.map(_ctf_series_to_cets, ts_files, defocus_files, out_yaml_files)
+        )
+
 
 # # READER EXAMPLE
 # import yaml
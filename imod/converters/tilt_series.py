@@ -1,8 +1,7 @@
 import traceback
 from pathlib import Path
-from typing import Optional, List
+from typing import IO, Callable, Optional, List, Sequence, Tuple
 import numpy as np
-import yaml
 from cets_data_model.models.models import (
     Affine,
     CTFMetadata,
@@ -18,9 +17,9 @@ from cets_data_model.models.models import (
     Vector3D,
     Matrix3x3,
 )
-from cets_data_model.utils.image_utils import get_mrc_info
 from imod.contants import MRC_MRCS_EXT
 from imod.utils.utils import (
+    get_mrc_info_cached,
     validate_file,
     validate_tilt_angle_list,
     parse_tlt_file,
@@ -29,8 +28,9 @@ from imod.utils.utils import (
     validate_even_odd_files,
     write_tlt,
     write_xf,
-    validate_new_file,
     load_md_list_yaml,
+    validate_md_output,
+    write_md_dict,
 )
 
 
@@ -38,22 +38,28 @@ class ImodTiltSeries:
     def __init__(
         self,
         ts_file_name: str | Path,
-        tilt_angles: str | Path | List[float],
+        tilt_angles: str | Path | List[float] | Tuple[float, ...] | np.ndarray,
         ctf_md_list: Optional[List[CTFMetadata]] = None,
     ) -> None:
         self.ts_file_name = validate_file(ts_file_name, "ts_file_name", MRC_MRCS_EXT)
-        if type(tilt_angles) is List[float]:
-            tilt_angles = validate_tilt_angle_list(self.ts_file_name, tilt_angles)
+        tilt_angle_list: List[float]
+        if isinstance(tilt_angles, (list, tuple, np.ndarray)):
+            # The angles are stored as a list of Python floats, as when they are
+            # read from a tlt file
+            tilt_angle_list = np.asarray(tilt_angles, dtype=np.float64).tolist()
+            tilt_angle_list = validate_tilt_angle_list(
+                self.ts_file_name, tilt_angle_list
+            )
             tlt_file, dose_list, acq_orders = None, None, None
         else:
             tlt_file = validate_file(
-                str(tilt_angles), "tilt_angles", [".tlt", ".rawtlt"]
+                str(tilt_angles), "tilt_angles", (".tlt", ".rawtlt")
             )
-            tilt_angles, dose_list, acq_orders = parse_tlt_file(tlt_file)
-        n_imgs = len(tilt_angles)
+            tilt_angle_list, dose_list, acq_orders = parse_tlt_file(tlt_file)
+        n_imgs = len(tilt_angle_list)
         self.ctf_md_list = validate_ctf_md_list(ctf_md_list, n_imgs)
         self.tlt_file = tlt_file
-        self.tilt_angles = tilt_angles
+        self.tilt_angles = tilt_angle_list
         self.dose_list = dose_list
         self.acq_orders = acq_orders
         self.n_imgs = n_imgs
@@ -64,7 +70,9 @@ class ImodTiltSeries:
         even_stack_file_name: str | Path | None = None,
         odd_stack_file_name: str | Path | None = None,
         ctf_corrected: bool = False,
-        out_yaml_file: str | Path | None = None,
+        out_yaml_file: str | Path | IO[str] | None = None,
+        validate: bool = False,
+        out_format: str = "yaml",
     ) -> TiltSeries:
         """Converts an IMOD tilt-series into CETS metadata.
 
@@ -83,56 +91,115 @@ class ImodTiltSeries:
         :type ctf_corrected: bool, optional
 
         :param out_yaml_file: name of the yaml file in which the tilt-series
-        metadata will be written.
-        :type out_yaml_file: pathlib.Path or str, optional
+        metadata will be written, or a yaml stream opened with md_yaml_writer, to
+        which it will be added as a new YAML document.
+        :type out_yaml_file: pathlib.Path or str or file object, optional
+
+        :param validate: flag to indicate if the generated TiltSeries, TiltImage and
+        transformation objects should be validated by Pydantic. The input data is
+        already validated, so it is skipped by default.
+        :type validate: bool, optional, Defaults to False
+
+        :param out_format: format of the output metadata file, "yaml" or "json".
+        :type out_format: str, optional, Defaults to "yaml"
         """
+        out_format = validate_md_output(out_yaml_file, out_format)
         # Validate even/odd
         even_stack_file_name, odd_stack_file_name = validate_even_odd_files(
             even_stack_file_name, odd_stack_file_name
         )
         # Read image info
-        img_info = get_mrc_info(self.ts_file_name)
+        img_info = get_mrc_info_cached(self.ts_file_name)
         width = img_info.size_x
         height = img_info.size_y
         # pix_size = img_info.apix_x
-        # Parse xf file
-        xf_file = validate_file(xf_file, "xf_file", ".xf")
-        in_rotation_matrix_pile, in_translation_vector_pile = parse_xf_file(xf_file)
+        if xf_file is None:
+            # No alignment data, so the identity transformation is used
+            in_rotation_matrix_pile = np.zeros((self.n_imgs, 2, 3))
+            in_rotation_matrix_pile[:, 0, 0] = in_rotation_matrix_pile[:, 1, 1] = 1
+            in_translation_vector_pile = np.zeros((self.n_imgs, 3))
+        else:
+            # Parse xf file
+            xf_file = validate_file(xf_file, "xf_file", ".xf")
+            in_rotation_matrix_pile, in_translation_vector_pile = parse_xf_file(xf_file)
+            n_transforms = in_rotation_matrix_pile.shape[0]
+            if n_transforms != self.n_imgs:
+                raise ValueError(
+                    f"The xf file {xf_file} contains {n_transforms} transformations, "
+                    f"but the tilt-series {self.ts_file_name} contains {self.n_imgs} "
+                    f"tilt-images."
+                )
+        # If all the tilt-images have the identity transformation, it is generated once
+        # and the same objects are shared by all of them, so they must not be modified
+        is_identity = self._is_identity_transform(
+            in_rotation_matrix_pile, in_translation_vector_pile
+        )
+        if is_identity:
+            in_rotation_matrix_pile = in_rotation_matrix_pile[:1]
+            in_translation_vector_pile = in_translation_vector_pile[:1]
 
         ts_filename = str(self.ts_file_name)
+        # The even/odd paths are str fields in the model
+        even_path = None if even_stack_file_name is None else str(even_stack_file_name)
+        odd_path = None if odd_stack_file_name is None else str(odd_stack_file_name)
         ts_id = self.ts_file_name.stem
         pixel_size = img_info.apix_x
         axis_xy = Axis(
             name=SpaceAxis.Z, axis_unit=AxisUnit.pixel, axis_type=AxisType.space
         )
-        coordinate_systems = CoordinateSystem(name="IMOD", axes=[axis_xy])
-        ti_list = []
-        for index in range(self.n_imgs):
-            output_translation_transform = in_translation_vector_pile[:, index]
-            output_rotation_matrix = in_rotation_matrix_pile[:, :, index]
-            ti = TiltImage(
+        # The same coordinate system list is shared by all the tilt-images
+        coordinate_systems = [CoordinateSystem(name="IMOD", axes=[axis_xy])]
+        # Per-image values, with a list of Nones in place of the missing ones
+        n_imgs = self.n_imgs
+        tilt_angles = self.tilt_angles
+        none_list: List[None] = [None] * n_imgs
+        dose_list: Sequence[Optional[float]] = self.dose_list or none_list
+        ctf_md_list: Sequence[Optional[CTFMetadata]] = self.ctf_md_list or none_list
+        acq_orders: Sequence[Optional[int]] = self.acq_orders or none_list
+        tilt_image_cls: Callable[..., TiltImage]
+        tilt_series_cls: Callable[..., TiltSeries]
+        if validate:
+            tilt_image_cls, tilt_series_cls = TiltImage, TiltSeries
+        else:
+            tilt_image_cls = TiltImage.model_construct
+            tilt_series_cls = TiltSeries.model_construct
+        # Transformations of all the tilt-images, with the values converted at once
+        translation_list = [
+            self._gen_translation_transform(translation_vector, validate=validate)
+            for translation_vector in self._get_translation_values(
+                in_translation_vector_pile, pixel_size
+            )
+        ]
+        affine_list = [
+            self._gen_affine_transform(affine_matrix, validate=validate)
+            for affine_matrix in self._get_affine_values(in_rotation_matrix_pile)
+        ]
+        if is_identity:
+            translation_list *= n_imgs
+            affine_list *= n_imgs
+        ti_list = [
+            tilt_image_cls(
                 path=ts_filename,
-                even_path=even_stack_file_name,
-                odd_path=odd_stack_file_name,
+                even_path=even_path,
+                odd_path=odd_path,
                 section=index,
-                nominal_tilt_angle=self.tilt_angles[index],
-                accumulated_dose=self.dose_list[index] if self.dose_list else None,
-                ctf_metadata=self.ctf_md_list[index] if self.ctf_md_list else None,
+                nominal_tilt_angle=tilt_angles[index],
+                accumulated_dose=dose_list[index],
+                ctf_metadata=ctf_md_list[index],
                 width=width,
                 height=height,
-                coordinate_systems=[coordinate_systems],
+                coordinate_systems=coordinate_systems,
                 coordinate_transformations=[
-                    self._gen_translation_transform(
-                        output_translation_transform, pixel_size
-                    ),
-                    self._gen_affine_transform(output_rotation_matrix),
+                    translation_list[index],
+                    affine_list[index],
                 ],
                 ts_id=ts_id,
-                acquisition_order=self.acq_orders[index] if self.acq_orders else None,
+                acquisition_order=acq_orders[index],
                 # pixel_size=pixel_size,
             )
-            ti_list.append(ti)
-        ts = TiltSeries(
+            for index in range(n_imgs)
+        ]
+        ts = tilt_series_cls(
             path=ts_filename,
             ts_id=ts_id,
             # pixel_size=pixel_size,
@@ -140,7 +207,7 @@ class ImodTiltSeries:
             images=ti_list,
         )
         # Write the output yaml file if requested
-        self._write_ts_yaml(ts, out_yaml_file)
+        self._write_ts_yaml(ts, out_yaml_file, out_format=out_format)
         return ts
 
     @staticmethod
@@ -173,56 +240,82 @@ class ImodTiltSeries:
             # Write the xf file
             write_xf(cets_ts, xf_file)
 
+    @staticmethod
     def _gen_affine_transform(
-        self,
-        rotation_matrix: np.ndarray,
+        affine_matrix: Matrix3x3, validate: bool = True
     ) -> CoordinateTransformation:
-        return Affine(
-            affine=self._get_affine_values(rotation_matrix),
+        affine_cls: Callable[..., Affine]
+        if validate:
+            affine_cls = Affine
+        else:
+            affine_cls = Affine.model_construct
+        return affine_cls(
+            affine=affine_matrix,
             name="IMOD rotation from a .xf file.",
             input="Tilt-image",
             output="Aligned tilt-image (rotation-corrected)",
         )
 
+    @staticmethod
     def _gen_translation_transform(
-        self, translation_matrix: np.ndarray, pix_size: float = 1.0
+        translation_vector: Vector3D, validate: bool = True
     ) -> Translation:
-        return Translation(
-            translation=self._get_translation_values(translation_matrix, pix_size),
+        translation_cls: Callable[..., Translation]
+        if validate:
+            translation_cls = Translation
+        else:
+            translation_cls = Translation.model_construct
+        return translation_cls(
+            translation=translation_vector,
             name="IMOD translation from a .xf file. Shifts in angstroms.",
             input="Tilt-image",
             output="Aligned tilt-image (translation-corrected)",
         )
 
     @staticmethod
-    def _get_affine_values(xf_matrix: np.ndarray) -> Matrix3x3:
-        """Gets the rotation angle in degrees."""
-        xf_matrix = xf_matrix.tolist()
-        row1: Vector3D = xf_matrix[0]
-        row2: Vector3D = xf_matrix[1]
-        row3: Vector3D = [0, 0, 1]
-        affine_matrix: Matrix3x3 = [row1, row2, row3]
-        return affine_matrix
+    def _is_identity_transform(
+        rotation_matrix_pile: np.ndarray, translation_vector_pile: np.ndarray
+    ) -> bool:
+        """Checks if the transformation of all the tilt-images is the identity."""
+        return bool(
+            np.array_equal(
+                rotation_matrix_pile,
+                np.broadcast_to(np.eye(2, 3), rotation_matrix_pile.shape),
+            )
+            and not translation_vector_pile.any()
+        )
+
+    @staticmethod
+    def _get_affine_values(rotation_matrix_pile: np.ndarray) -> List[Matrix3x3]:
+        """Gets the 3 x 3 affine matrix of each tilt-image from the n x 2 x 3
+        rotation matrix pile."""
+        n_imgs = rotation_matrix_pile.shape[0]
+        affine_pile = np.empty((n_imgs, 3, 3), dtype=np.float64)
+        affine_pile[:, :2, :] = rotation_matrix_pile
+        affine_pile[:, 2, :] = [0, 0, 1]
+        return affine_pile.tolist()
 
     @staticmethod
     def _get_translation_values(
-        translation_matrix: np.ndarray, pix_size: float = 1.0
-    ) -> Vector3D:
-        """Gets the shifts in X and Y directions, in angstroms."""
-        translation_matrix *= pix_size  # convert to angstroms
-        translation_vector: Vector3D = translation_matrix.tolist()
-        return translation_vector
+        translation_vector_pile: np.ndarray, pix_size: float = 1.0
+    ) -> List[Vector3D]:
+        """Gets the shifts in X and Y directions of each tilt-image, in angstroms,
+        from the n x 3 translation vector pile."""
+        # Convert to angstroms
+        return (translation_vector_pile * pix_size).tolist()
 
     @staticmethod
-    def _write_ts_yaml(cets_ts_md: TiltSeries, yaml_file: Path | str | None) -> None:
+    def _write_ts_yaml(
+        cets_ts_md: TiltSeries,
+        yaml_file: Path | str | IO[str] | None,
+        out_format: str = "yaml",
+    ) -> None:
         if yaml_file is None:
             print("write_yaml -> yaml_file is None. Skipping...")
             return
         try:
-            yaml_file = validate_new_file(yaml_file)
             metadata_dict = cets_ts_md.model_dump(mode="json")
-            with open(yaml_file, "a") as f:
-                yaml.dump(metadata_dict, f, sort_keys=False, explicit_start=True)
+            yaml_file = write_md_dict(metadata_dict, yaml_file, out_format=out_format)
             print(f"yaml file successfully written! -> {yaml_file}")
         except Exception as e:
             print(
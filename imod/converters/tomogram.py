@@ -1,11 +1,15 @@
 import traceback
 from pathlib import Path
-
-import yaml
+from typing import IO
 
 from cets_data_model.models.models import Tomogram
-from cets_data_model.utils.image_utils import get_mrc_info
-from imod.utils.utils import validate_even_odd_files, validate_new_file, validate_file
+from imod.utils.utils import (
+    get_mrc_info_cached,
+    validate_even_odd_files,
+    validate_file,
+    validate_md_output,
+    write_md_dict,
+)
 
 
 class ImodTomogram:
@@ -17,7 +21,8 @@ class ImodTomogram:
         even_file_name: Path | str | None = None,
         odd_file_name: Path | str | None = None,
         ctf_corrected: bool = False,
-        out_yaml_file: str | Path | None = None,
+        out_yaml_file: str | Path | IO[str] | None = None,
+        out_format: str = "yaml",
     ) -> Tomogram:
         """Converts an IMOD tomogran into CETS metadata.
 
@@ -32,16 +37,21 @@ class ImodTomogram:
         :type ctf_corrected: bool, optional
 
         :param out_yaml_file: name of the yaml file in which the tomogram
-        metadata will be written.
-        :type out_yaml_file: pathlib.Path or str, optional
+        metadata will be written, or a yaml stream opened with md_yaml_writer, to
+        which it will be added as a new YAML document.
+        :type out_yaml_file: pathlib.Path or str or file object, optional
+
+        :param out_format: format of the output metadata file, "yaml" or "json".
+        :type out_format: str, optional, Defaults to "yaml"
         """
+        out_format = validate_md_output(out_yaml_file, out_format)
         # Validate even/odd
         even_file_name, odd_file_name = validate_even_odd_files(
             even_file_name, odd_file_name
         )
         # Read image info
         tomo_filename = str(self.file_name)
-        image_info_obj = get_mrc_info(tomo_filename)
+        image_info_obj = get_mrc_info_cached(tomo_filename)
         tomo = Tomogram(
             path=tomo_filename,
             tomo_id=self.file_name.stem,
@@ -54,22 +64,24 @@ class ImodTomogram:
             odd_path=str(odd_file_name),
         )
         # Write the output yaml file if requested
-        self._write_ts_yaml(tomo, out_yaml_file)
+        self._write_ts_yaml(tomo, out_yaml_file, out_format=out_format)
         return tomo
 
     # def cets_to_imod(self):
     #     pass
 
     @staticmethod
-    def _write_ts_yaml(cets_ts_md: Tomogram, yaml_file: Path | str | None) -> None:
+    def _write_ts_yaml(
+        cets_ts_md: Tomogram,
+        yaml_file: Path | str | IO[str] | None,
+        out_format: str = "yaml",
+    ) -> None:
         if yaml_file is None:
             print("write_yaml -> yaml_file is None. Skipping...")
             return
         try:
-            yaml_file = validate_new_file(yaml_file)
             metadata_dict = cets_ts_md.model_dump(mode="json")
-            with open(yaml_file, "a") as f:
-                yaml.dump(metadata_dict, f, sort_keys=False, explicit_start=True)
+            yaml_file = write_md_dict(metadata_dict, yaml_file, out_format=out_format)
             print(f"yaml file successfully written! -> {yaml_file}")
         except Exception as e:
             print(
@@ -2,10 +2,13 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
 import os
 from typing import Final, List
 
+import numpy as np
+
 # Test root
 TEST_DATA_ROOT: Final[Path] = Path(
     os.getenv("TEST_DATA_ROOT", Path(__file__).parent / "test_data")
@@ -30,6 +33,15 @@ DEFOCUS_V: Final[str] = "defocus_v"
 DEFOCUS_ANGLE: Final[str] = "defocus_angle"
 PHASE_SHIFT: Final[str] = "phase_shift"
 CUTOFF_FREQ: Final[str] = "cutoff_freq"
+# Columns of the defocus files for each IMOD flag
+DEFOCUS_FLAG_0_FIELDS: Final[tuple[str, ...]] = DEFOCUS_COMMON_FIELDS
+DEFOCUS_FLAG_1_FIELDS: Final[tuple[str, ...]] = DEFOCUS_COMMON_FIELDS + (
+    DEFOCUS_V,
+    DEFOCUS_ANGLE,
+)
+DEFOCUS_FLAG_4_FIELDS: Final[tuple[str, ...]] = DEFOCUS_COMMON_FIELDS + (PHASE_SHIFT,)
+DEFOCUS_FLAG_5_FIELDS: Final[tuple[str, ...]] = DEFOCUS_FLAG_1_FIELDS + (PHASE_SHIFT,)
+DEFOCUS_FLAG_37_FIELDS: Final[tuple[str, ...]] = DEFOCUS_FLAG_5_FIELDS + (CUTOFF_FREQ,)
 
 
 # Immutable metadata per fixture
@@ -43,36 +55,63 @@ class Fixture:
     n_imgs: int = N_IMGS_TS03
 
 
+@lru_cache(maxsize=32)
+def _siblings_listing(folder: Path) -> str:
+    """Sorted list of the files in a test data folder, formatted for the error
+    message of a missing test file. It is built only once per folder."""
+    try:
+        with os.scandir(folder) as entries:
+            names = sorted(entry.name for entry in entries if entry.is_file())
+    except OSError:
+        return " (folder missing)"
+    return "\n  - " + "\n  - ".join(names)
+
+
+@lru_cache(maxsize=None)
+def _get_test_file_path(relpath: Path) -> Path:
+    """Canonical, validated path on disk, as the one returned by validate_file. It is
+    checked only once per test file."""
+    # TEST_DATA_ROOT or any of its parents may be a symlink too
+    p = os.path.realpath(TEST_DATA_ROOT / relpath)
+    if not os.path.isfile(p):
+        # Show siblings in the expected folder (concise and actionable)
+        folder = Path(p).parent
+        siblings = _siblings_listing(folder)
+        raise FileNotFoundError(
+            f"Test file not found: {p}\nSiblings in {folder}:{siblings}"
+        )
+    return Path(p)
+
+
 class ImodTestDataFiles(Enum):
     defocus_plain_estimation = Fixture(
         relpath=CTF_DATA_DIR / "TS_03_plain_estimation.defocus",
         imod_flag=0,
-        column_names=DEFOCUS_COMMON_FIELDS,
+        column_names=DEFOCUS_FLAG_0_FIELDS,
         description="CTF - plain estimation",
     )
     defocus_only_astigmatism = Fixture(
         relpath=CTF_DATA_DIR / "TS_03_only_astigmatism.defocus",
         imod_flag=1,
-        column_names=DEFOCUS_COMMON_FIELDS + (DEFOCUS_V, DEFOCUS_ANGLE),
+        column_names=DEFOCUS_FLAG_1_FIELDS,
         description="CTF - only astigmatism",
     )
     defocus_only_phase_shift = Fixture(
         relpath=CTF_DATA_DIR / "TS_03_only_phase_shift.defocus",
         imod_flag=4,
-        column_names=DEFOCUS_COMMON_FIELDS + (PHASE_SHIFT,),
+        column_names=DEFOCUS_FLAG_4_FIELDS,
         description="CTF - only phase shift",
     )
     defocus_astig_and_phase_shift = Fixture(
         relpath=CTF_DATA_DIR / "TS_03_astigmatism_and_phase_shift.defocus",
         imod_flag=5,
-        column_names=DEFOCUS_COMMON_FIELDS + (DEFOCUS_V, DEFOCUS_ANGLE, PHASE_SHIFT),
+        column_names=DEFOCUS_FLAG_5_FIELDS,
         description="CTF - astigmatism and phase shift",
     )
     defocus_astig_phase_shift_and_cutoff_freq = Fixture(
         relpath=CTF_DATA_DIR / "TS_03_astigmatism_phase_shift_and_cutoff_freq.defocus",
         imod_flag=37,
-        column_names=DEFOCUS_COMMON_FIELDS
-        + (DEFOCUS_V, DEFOCUS_ANGLE, PHASE_SHIFT, CUTOFF_FREQ),
+        column_names=DEFOCUS_FLAG_37_FIELDS,
         description="CTF - astigmatism, phase shift and cutoff frequency",
     )
     ts_03_mrcs = Fixture(relpath=TS_DATA_DIR / "TS_03.mrcs")
@@ -88,20 +127,7 @@ class ImodTestDataFiles(Enum):
     @property
     def path(self) -> Path:
         """Absolute, validated path on disk."""
-        p = (TEST_DATA_ROOT / self.value.relpath).resolve()
-        if not p.is_file():
-            # Show siblings in the expected folder (concise and actionable)
-            folder = p.parent
-            siblings = (
-                "\n  - "
-                + "\n  - ".join(sorted(f.name for f in folder.glob("*") if f.is_file()))
-                if folder.exists()
-                else " (folder missing)"
-            )
-            raise FileNotFoundError(
-                f"Test file not found: {p}\nSiblings in {folder}:{siblings}"
-            )
-        return p
+        return _get_test_file_path(self.value.relpath)
 
     @property
     def imod_flag(self) -> int:
@@ -123,36 +149,25 @@ class ImodTestDataFiles(Enum):
     #     return self.path.open(mode)
 
     def get_test_dict_list(self) -> List[dict]:
-        with open(self.path, "r") as f:
-            lines = f.readlines()
-
-        # Convert lines to list of lists of values
-        data = []
-        for line in lines:
-            parts = line.strip().split()
-            row = []
-            for part in parts:
-                value = float(part)
-                if value.is_integer():
-                    value = int(value)
-                row.append(value)
-            data.append(row)
-
-        # Adjust based on imod_flag
         keys = self.column_names
         if self.imod_flag == 0:
-            if len(data) > 0 and len(data[0]) > len(keys):
-                data[0] = data[0][: len(keys)]
-        elif self.imod_flag > 0:
-            data = data[1:]
-
-        # Build the list of dictionaries
-        dict_list = []
-        for row in data:
-            row_dict = dict(zip(keys, row))
-            dict_list.append(row_dict)
-
-        return dict_list
+            # The first line contains an extra value, so only the expected columns
+            # are read
+            data = np.loadtxt(
+                self.path, dtype=np.float64, usecols=range(len(keys)), ndmin=2
+            )
+        else:
+            # The first line contains only the flag and format info
+            data = np.loadtxt(self.path, dtype=np.float64, skiprows=1, ndmin=2)
+
+        # Build the list of dictionaries, with the integer values as int
+        return [
+            {
+                key: int(value) if value.is_integer() else value
+                for key, value in zip(keys, row)
+            }
+            for row in data.tolist()
+        ]
 
 
 # # Access file + metadata
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
+import json
 import os
+import shutil
 import tempfile
 from pathlib import Path
 from typing import List
 from unittest import TestCase
 
-from cets_data_model.models.models import CTFMetadata
-from imod.converters.ctf import ImodCtfSeries
+import mrcfile
+import numpy as np
+import yaml
+from cets_data_model.models.models import CTFMetadata, Tomogram
+from imod.converters.ctf import ImodCtfSeries, convert_many
+from imod.converters.tilt_series import ImodTiltSeries
+from imod.converters.tomogram import ImodTomogram
 from imod.tests import (
     ImodTestDataFiles,
     DEFOCUS_U,
@@ -14,10 +21,29 @@ from imod.tests import (
     DEFOCUS_ANGLE,
     PHASE_SHIFT,
 )
+from imod.utils.utils import (
+    dump_md_dict,
+    load_md_list_yaml,
+    load_mrc_file,
+    md_yaml_writer,
+    parse_tlt_file,
+    standarize_defocus,
+    standarize_defocus_batch,
+    validate_file,
+)
 
 CETS_IMOD_CTF = "cets_imod_ctf"
 
 
+def _tmp_root() -> str | None:
+    """Folder for the test outputs. A TMPDIR set by the user is respected;
+    otherwise the outputs go to the /dev/shm tmpfs, if available, to keep the small
+    file writes off the disk."""
+    if "TMPDIR" not in os.environ and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None  # tempfile default
+
+
 class CetsImodBaseTest(TestCase):
     # Files
     ts_fn = ImodTestDataFiles.ts_03_mrcs.path
@@ -30,10 +56,16 @@ class CetsImodBaseTest(TestCase):
         """
         Setup test data and output directories.
         """
-        cls.test_dir = Path(tempfile.mkdtemp(prefix=CETS_IMOD_CTF))
-        # Change to test directory
-        cls._orig_dir = os.getcwd()
-        os.chdir(cls.test_dir)
+        # The outputs are written with explicit paths under test_dir, so the working
+        # directory is not changed and test classes can run in parallel processes
+        cls.test_dir = Path(tempfile.mkdtemp(prefix=CETS_IMOD_CTF, dir=_tmp_root()))
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Remove the output directory, as mkdtemp does not clean it up.
+        """
+        shutil.rmtree(cls.test_dir, ignore_errors=True)
 
 
 class CetsImodDefocusReaderTest(CetsImodBaseTest):
@@ -100,6 +132,76 @@ class CetsImodDefocusReaderTest(CetsImodBaseTest):
         defocus_testdata = ImodTestDataFiles.defocus_astig_phase_shift_and_cutoff_freq
         self._run_test_imod_to_cets(defocus_testdata)
 
+    def test_ctf_imod_to_cets_many(self):
+        print("\n ===> Running IMOD to CETS CTF - several tilt-series in parallel")
+        defocus_testdata_list = [
+            ImodTestDataFiles.defocus_plain_estimation,
+            ImodTestDataFiles.defocus_astig_phase_shift_and_cutoff_freq,
+        ]
+        yaml_files = [
+            self.test_dir / f"TS_03_cets_ctf_{i}.yaml"
+            for i in range(len(defocus_testdata_list))
+        ]
+        cets_ctf_md_lists = convert_many(
+            [self.ts_fn] * len(defocus_testdata_list),
+            [defocus_testdata.path for defocus_testdata in defocus_testdata_list],
+            yaml_files,
+            max_workers=2,
+        )
+        for defocus_testdata, cets_ctf_md_list, yaml_file in zip(
+            defocus_testdata_list, cets_ctf_md_lists, yaml_files
+        ):
+            self._check_data(defocus_testdata, cets_ctf_md_list, yaml_file)
+
+    def test_ctf_fast_yaml(self):
+        print("\n ===> Running CETS CTF fast yaml writer")
+        ics = ImodCtfSeries(
+            ts_file_name=self.ts_fn,
+            defocus_file=ImodTestDataFiles.defocus_astig_and_phase_shift.path,
+        )
+        cets_ctf_md_list = ics.imod_to_cets()
+        # Add some values requiring special formatting
+        cets_ctf_md_list[0].phase_shift = 1e-05
+        cets_ctf_md_list[1].phase_shift = float("inf")
+        cets_ctf_md_list[2].phase_shift = None
+        yaml_files = []
+        for fast_yaml in (True, False):
+            yaml_file = self.test_dir / f"TS_03_cets_ctf_fast_{fast_yaml}.yaml"
+            ics._write_ctf_yaml(cets_ctf_md_list, yaml_file, fast_yaml=fast_yaml)
+            yaml_files.append(yaml_file)
+        fast_yaml_file, yaml_file = yaml_files
+        self.assertEqual(fast_yaml_file.read_text(), yaml_file.read_text())
+        with open(fast_yaml_file) as f:
+            docs = list(yaml.safe_load_all(f))
+        self.assertEqual(docs, [ctf_md.model_dump() for ctf_md in cets_ctf_md_list])
+
+    def test_ctf_expand_ranges(self):
+        print("\n ===> Running IMOD CTF ranges expansion")
+        # The second row has end < start, so it covers no tilt-image
+        table = np.array([[1, 2, 0.0], [5, 3, 0.0], [3, 3, 0.0], [4, 6, 0.0]])
+        indices, counts = ImodCtfSeries._expand_ranges(table)
+        self.assertEqual(indices.tolist(), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(counts.tolist(), [2, 0, 1, 3])
+
+
+class CetsImodTomogramReaderTest(CetsImodBaseTest):
+    def test_tomo_yaml_writer(self):
+        print("\n ===> Running IMOD to CETS tomograms into a single yaml stream")
+        yaml_file_tomo = self.test_dir / "TS_03_cets_tomos.yaml"
+        it = ImodTomogram(tomo_file=self.tomo_fn)
+        n_tomos = 3
+        with md_yaml_writer(yaml_file_tomo) as f:
+            cets_tomo_md_list = [
+                it.imod_to_cets(out_yaml_file=f) for _ in range(n_tomos)
+            ]
+        tomo_md_dict_list = load_md_list_yaml(yaml_file_tomo, Tomogram)
+        self.assertEqual(len(tomo_md_dict_list), n_tomos)
+        for tomo_md_dict, cets_tomo_md in zip(tomo_md_dict_list, cets_tomo_md_list):
+            self.assertEqual(tomo_md_dict, cets_tomo_md.model_dump(mode="json"))
+        with md_yaml_writer(yaml_file_tomo) as f:
+            with self.assertRaises(ValueError):
+                it.imod_to_cets(out_yaml_file=f, out_format="json")
+
 
 class CetsImodTsReaderTest(CetsImodBaseTest):
     yaml_file_ts = Path()
@@ -109,6 +211,98 @@ class CetsImodTsReaderTest(CetsImodBaseTest):
         super().setUpClass()
         cls.yaml_file_ts = cls.test_dir / "TS_03_cets_ts.yaml"
 
+    def test_ts_tilt_angle_list(self):
+        print("\n ===> Running IMOD tilt-series from a list of tilt angles")
+        tilt_angles, _, _ = parse_tlt_file(self.tlt_fn)
+        its = ImodTiltSeries(ts_file_name=self.ts_fn, tilt_angles=tilt_angles)
+        # The tilt angles are taken as provided, without reading any tlt file
+        self.assertIsNone(its.tlt_file)
+        self.assertEqual(its.tilt_angles, tilt_angles)
+        self.assertIsNone(its.dose_list)
+        with self.assertRaises(ValueError):
+            ImodTiltSeries(ts_file_name=self.ts_fn, tilt_angles=tilt_angles[:-1])
+
+    def test_ts_identity_transform(self):
+        print("\n ===> Running IMOD to CETS tilt-series without alignment")
+        its = ImodTiltSeries(ts_file_name=self.ts_fn, tilt_angles=self.tlt_fn)
+        cets_ts_md = its.imod_to_cets()
+        self.assertEqual(len(cets_ts_md.images), its.n_imgs)
+        translation, affine = cets_ts_md.images[0].coordinate_transformations
+        self.assertEqual(translation.translation, [0.0, 0.0, 0.0])
+        self.assertEqual(
+            affine.affine, [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+        )
+        # The identity transformation objects are shared by all the tilt-images
+        for ti in cets_ts_md.images:
+            self.assertIs(ti.coordinate_transformations[0], translation)
+            self.assertIs(ti.coordinate_transformations[1], affine)
+
+    def test_ts_xf_n_imgs_mismatch(self):
+        print("\n ===> Running IMOD to CETS tilt-series with a wrong xf file")
+        its = ImodTiltSeries(ts_file_name=self.ts_fn, tilt_angles=self.tlt_fn)
+        # A single identity transformation for a tilt-series with 40 tilt-images
+        xf_file = self.test_dir / "TS_03_single_identity.xf"
+        xf_file.write_text("1.0 0.0 0.0 1.0 0.0 0.0\n")
+        with self.assertRaises(ValueError):
+            its.imod_to_cets(xf_file=xf_file)
+
+    def test_ts_even_odd(self):
+        print("\n ===> Running IMOD to CETS tilt-series with even/odd stacks")
+        its = ImodTiltSeries(ts_file_name=self.ts_fn, tilt_angles=self.tlt_fn)
+        md_dicts = []
+        for validate in [False, True]:
+            yaml_file_ts = self.test_dir / f"TS_03_cets_ts_even_odd_{validate}.yaml"
+            cets_ts_md = its.imod_to_cets(
+                xf_file=self.xf_fn,
+                even_stack_file_name=self.ts_fn,
+                odd_stack_file_name=self.ts_fn,
+                out_yaml_file=yaml_file_ts,
+                validate=validate,
+            )
+            for ti in cets_ts_md.images:
+                self.assertEqual(ti.even_path, str(self.ts_fn))
+                self.assertEqual(ti.odd_path, str(self.ts_fn))
+            md_dict = cets_ts_md.model_dump(mode="json")
+            with open(yaml_file_ts) as f:
+                self.assertEqual(yaml.safe_load(f), md_dict)
+            md_dicts.append(md_dict)
+        self.assertEqual(md_dicts[0], md_dicts[1])
+
+    def test_ts_json_output(self):
+        print("\n ===> Running IMOD to CETS tilt-series with JSON output")
+        json_file_ts = self.test_dir / "TS_03_cets_ts.json"
+        its = ImodTiltSeries(ts_file_name=self.ts_fn, tilt_angles=self.tlt_fn)
+        cets_ts_md = its.imod_to_cets(
+            xf_file=self.xf_fn, out_yaml_file=json_file_ts, out_format="json"
+        )
+        metadata_dict = cets_ts_md.model_dump(mode="json")
+        with open(json_file_ts) as f:
+            self.assertEqual(json.load(f), metadata_dict)
+        # JSON is also valid YAML
+        with open(json_file_ts) as f:
+            self.assertEqual(yaml.safe_load(f), metadata_dict)
+        with self.assertRaises(ValueError):
+            its.imod_to_cets(xf_file=self.xf_fn, out_format="xml")
+
+    def test_ts_yaml_writer(self):
+        print("\n ===> Running IMOD to CETS tilt-series into a single yaml stream")
+        yaml_file_ts = self.test_dir / "TS_03_cets_ts_many.yaml"
+        its = ImodTiltSeries(ts_file_name=self.ts_fn, tilt_angles=self.tlt_fn)
+        n_ts = 3
+        with md_yaml_writer(yaml_file_ts) as f:
+            cets_ts_md_list = [
+                its.imod_to_cets(xf_file=self.xf_fn, out_yaml_file=f)
+                for _ in range(n_ts)
+            ]
+        with open(yaml_file_ts) as f:
+            docs = list(yaml.safe_load_all(f))
+        self.assertEqual(
+            docs, [cets_ts_md.model_dump(mode="json") for cets_ts_md in cets_ts_md_list]
+        )
+        with md_yaml_writer(yaml_file_ts) as f:
+            with self.assertRaises(ValueError):
+                its.imod_to_cets(out_yaml_file=f, out_format="json")
+
     def test_ts_imod_to_cets(self):
         # print("\n ===> Running IMOD to CETS tilt-series")
         # # Generate the CTF metadata
@@ -129,3 +323,85 @@ class CetsImodTsReaderTest(CetsImodBaseTest):
         # Check the metadata generated
         # TODO finish this once the data model is decided
         raise Exception("finish this once the data model is decided")
+
+
+class CetsImodUtilsTest(CetsImodBaseTest):
+    def test_validate_file_cache(self):
+        print("\n ===> Running validate_file with relative paths and its cache")
+        dir_a = self.test_dir / "a"
+        dir_b = self.test_dir / "b"
+        dir_a.mkdir()
+        dir_b.mkdir()
+        mrc_file = dir_a / "x.mrc"
+        mrc_file.touch()
+        orig_dir = os.getcwd()
+        try:
+            # The same relative path is not validated from a different folder
+            os.chdir(dir_a)
+            self.assertEqual(
+                validate_file("x.mrc", "mrc_file", ".mrc"), mrc_file.resolve()
+            )
+            os.chdir(dir_b)
+            with self.assertRaises(FileNotFoundError):
+                validate_file("x.mrc", "mrc_file", ".mrc")
+            # The ".." after a symlink is resolved from the symlink target, so the
+            # file in a/ is found instead of a missing one in b/
+            (dir_a / "sub").mkdir()
+            (dir_b / "l").symlink_to(dir_a / "sub")
+            self.assertEqual(
+                validate_file("l/../x.mrc", "mrc_file", ".mrc"), mrc_file.resolve()
+            )
+        finally:
+            os.chdir(orig_dir)
+        # A valid file stays cached until the cache is cleared
+        mrc_file.unlink()
+        self.assertEqual(
+            validate_file(mrc_file, "mrc_file", ".mrc"), mrc_file.resolve()
+        )
+        validate_file.cache_clear()
+        with self.assertRaises(FileNotFoundError):
+            validate_file(mrc_file, "mrc_file", ".mrc")
+
+    def test_load_mrc_file(self):
+        print("\n ===> Running load_mrc_file against mrcfile")
+        # A small file with an extended header, to check the data offset
+        ext_mrc_file = self.test_dir / "ext_header.mrc"
+        with mrcfile.new(ext_mrc_file) as mrc:
+            mrc.set_data(np.arange(2 * 3 * 4, dtype=np.float32).reshape(2, 3, 4))
+            mrc.set_extended_header(np.zeros(10, dtype=np.int32))
+        for mrc_file in (self.ts_fn, self.tomo_fn, ext_mrc_file):
+            data = load_mrc_file(mrc_file)
+            expected_data = mrcfile.read(mrc_file)
+            self.assertEqual(data.dtype, expected_data.dtype)
+            np.testing.assert_array_equal(data, expected_data)
+
+    def test_standarize_defocus(self):
+        print("\n ===> Running standarize_defocus")
+        # (defocus_u, defocus_v, defocus_angle) -> expected standarized values
+        cases = [
+            ((1.0, 2.0, 10.0), (2.0, 1.0, 100.0)),  # swap when v > u, +90
+            ((1.0, 2.0, 120.0), (2.0, 1.0, 30.0)),  # swap, +90 wrapped
+            ((2.0, 2.0, 10.0), (2.0, 2.0, 10.0)),  # no swap when u == v
+            ((2.0, 1.0, 180.0), (2.0, 1.0, 0.0)),
+            ((2.0, 1.0, -10.0), (2.0, 1.0, 170.0)),
+            ((2.0, 1.0, 367.5), (2.0, 1.0, 7.5)),  # angles >= 360 are wrapped
+            ((2.0, 1.0, -187.5), (2.0, 1.0, 172.5)),  # and so are those < -180
+        ]
+        for in_values, expected_values in cases:
+            self.assertEqual(standarize_defocus(*in_values), expected_values)
+        # The batch version gives the same results
+        in_arrays = np.array([in_values for in_values, _ in cases]).T
+        expected_arrays = np.array([expected for _, expected in cases]).T
+        for out_array, expected_array in zip(
+            standarize_defocus_batch(*in_arrays), expected_arrays
+        ):
+            np.testing.assert_array_equal(out_array, expected_array)
+
+    def test_dump_md_dict_json_nan(self):
+        print("\n ===> Running dump_md_dict with a NaN value")
+        md_dict = {"defocus": float("nan")}
+        with open(self.test_dir / "nan.yaml", "w") as f:
+            dump_md_dict(md_dict, f, out_format="yaml")
+        with open(self.test_dir / "nan.json", "w") as f:
+            with self.assertRaises(ValueError):
+                dump_md_dict(md_dict, f, out_format="json")
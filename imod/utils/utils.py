@@ -1,44 +1,88 @@
+import json
 import os
+import stat
 import traceback
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 
 from pydantic import BaseModel
-from typing import Tuple, get_args, get_origin, Union, get_type_hints, List, Dict, Type
+from typing import (
+    IO,
+    Any,
+    Collection,
+    Iterator,
+    Tuple,
+    get_args,
+    get_origin,
+    Union,
+    List,
+    Dict,
+    Type,
+    NamedTuple,
+)
 import mrcfile
+from mrcfile.utils import data_dtype_from_header, data_shape_from_header
 import numpy as np
+import yaml
 
 from cets_data_model.models.models import CTFMetadata, TiltSeries
-from imod.contants import MRC_MRCS_EXT
+from imod.contants import MRC_MRCS_EXT, MD_FILE_FORMATS
 
 
 def validate_file(
-    filename: Path | str | None, field_name: str, expected_ext: str | List[str]
+    filename: Path | str | None,
+    field_name: str,
+    expected_ext: str | Collection[str],
 ) -> Path:
     if filename is None:
         raise ValueError(f"File read from field {field_name} cannot be None")
-    p = Path(filename).expanduser()
+    # Tuples, like the ones defined in imod.contants, are passed without a copy
+    expected_ext_list: Tuple[str, ...] = (
+        (expected_ext,) if isinstance(expected_ext, str) else tuple(expected_ext)
+    )
+    # The cache key is the absolute path, as a relative one depends on the current
+    # working directory. It is not normalized, as collapsing ".." before resolving
+    # the symlinks could point to a different file
+    abs_filename = str(Path(filename).expanduser().absolute())
+    return _validate_file(abs_filename, field_name, expected_ext_list)
+
+
+@lru_cache(maxsize=1024)
+def _validate_file(
+    filename: str, field_name: str, expected_ext_list: Tuple[str, ...]
+) -> Path:
+    """Validates an input file, given by its absolute path. Only the valid files are
+    cached, as the exceptions raised for the invalid ones are not, so a file that is
+    created after a failed validation is found in the next call."""
+    p = Path(filename)
+    # A single stat call checks both that the file exists and that it is a file
     try:
-        p = p.resolve(strict=True)
+        st = os.stat(p)
     except FileNotFoundError:
         raise FileNotFoundError(f"{field_name} does not exist: {p}") from None
 
-    if not p.is_file():
+    if not stat.S_ISREG(st.st_mode):
         raise IsADirectoryError(f"{field_name} must be a file, not a directory: {p}")
 
     if not os.access(p, os.R_OK):
         raise PermissionError(f"No read permission for {field_name}: {p}")
 
+    # The canonical path is kept, as it is the one written in the metadata
+    p = p.resolve()
     ext = p.suffix
-    expected_ext_list: List[str] = (
-        [expected_ext] if isinstance(expected_ext, str) else expected_ext
-    )
     if ext not in expected_ext_list:
         raise ValueError(
-            f"Invalid file extension '{ext}'. Expected one of: {expected_ext_list}"
+            f"Invalid file extension '{ext}'. "
+            f"Expected one of: {list(expected_ext_list)}"
         )
     return p
 
 
+# Clears the cached validations, e.g. after removing or renaming the input files
+validate_file.cache_clear = _validate_file.cache_clear  # type: ignore[attr-defined]
+
+
 def validate_even_odd_files(
     even_file_name: Path | str | None, odd_file_name: Path | str | None
 ) -> Tuple[Path | str | None, Path | str | None]:
@@ -55,20 +99,79 @@ def validate_even_odd_files(
     return even_file_name, odd_file_name
 
 
+def validate_md_file_format(out_format: str) -> str:
+    if out_format not in MD_FILE_FORMATS:
+        raise ValueError(
+            f"Invalid metadata file format '{out_format}'. Expected one of: "
+            f"{MD_FILE_FORMATS}"
+        )
+    return out_format
+
+
+def _read_mrc_header(mrc_file: Path | str) -> np.recarray:
+    """Reads only the header of an MRC file, without touching its data."""
+    with mrcfile.open(mrc_file, header_only=True, permissive=True) as mrc:
+        return mrc.header
+
+
+def get_mrc_shape(mrc_file: Path | str) -> Tuple[int, ...]:
+    """Returns the shape of the data of an MRC file, read from its header."""
+    return data_shape_from_header(_read_mrc_header(mrc_file))
+
+
 def load_mrc_file(mrc_file: Path) -> np.ndarray:
-    """Loads an MRC file"""
-    with mrcfile.mmap(mrc_file, mode="r", permissive=True) as mrc:
-        data = mrc.data
-    return data
+    """Loads an MRC file as a read-only memory-mapped array. Unlike the data of a
+    closed mrcfile.mmap, it remains valid when returned, and only the accessed data
+    is read from disk."""
+    header = _read_mrc_header(mrc_file)
+    return np.memmap(
+        mrc_file,
+        dtype=data_dtype_from_header(header),
+        mode="r",
+        offset=header.nbytes + int(header.nsymbt),
+        shape=data_shape_from_header(header),
+    )
 
 
 def get_ts_no_imgs(ts_file_name: Path):
-    """Loads a tilt-series mrc file and returns the number of images"""
-    data = load_mrc_file(ts_file_name)
-    dims = data.shape
+    """Reads the header of a tilt-series mrc file and returns the number of images"""
+    dims = get_mrc_shape(ts_file_name)
     return 1 if len(dims) < 2 else min(dims)
 
 
+class MrcInfo(NamedTuple):
+    size_x: int
+    size_y: int
+    size_z: int
+    apix_x: float
+    apix_y: float
+    apix_z: float
+
+
+def get_mrc_header_info(mrc_file: Path | str) -> MrcInfo:
+    """Returns the dimensions and the pixel size of an MRC file. They are read from
+    its header only, so no data is read from disk."""
+    header = _read_mrc_header(mrc_file)
+    sizes = (int(header.nx), int(header.ny), int(header.nz))
+    grid = (int(header.mx), int(header.my), int(header.mz))
+    cell = (header.cella.x, header.cella.y, header.cella.z)
+    # Same as mrcfile voxel_size: cell dimensions over sampling, stored as float32
+    apix = tuple(float(np.float32(c / g)) if g else 0.0 for c, g in zip(cell, grid))
+    return MrcInfo(*sizes, *apix)
+
+
+@lru_cache(maxsize=512)
+def _get_mrc_info(mrc_file: str, mtime_ns: int, size: int) -> MrcInfo:
+    return get_mrc_header_info(mrc_file)
+
+
+def get_mrc_info_cached(mrc_file: Path | str) -> MrcInfo:
+    """Returns the header info of an mrc file. It is read only once while the file
+    is not modified, as the cache key includes its modification time and size."""
+    st = os.stat(mrc_file)
+    return _get_mrc_info(str(mrc_file), st.st_mtime_ns, st.st_size)
+
+
 def validate_tilt_angle_list(
     ts_filename: Path, tilt_angle_list: List[float]
 ) -> List[float]:
@@ -84,15 +187,16 @@ def validate_ctf_md_list(
 ) -> List[CTFMetadata] | None:
     if ctf_md_list is None:
         return ctf_md_list
-    if not all(type(elem) is CTFMetadata for elem in ctf_md_list):
-        raise TypeError(
-            "All the elements in the ctf metadata provided must be of type CTFMetadata"
-        )
+    # The length is checked first, as it does not require iterating the list
     n_ctf_md = len(ctf_md_list)
     if n_ctf_md != expected_n_elements:
         raise ValueError(
             f"Expected {expected_n_elements} CTFMetadata elements, but got {n_ctf_md}."
         )
+    if not all(isinstance(elem, CTFMetadata) for elem in ctf_md_list):
+        raise TypeError(
+            "All the elements in the ctf metadata provided must be of type CTFMetadata"
+        )
     return ctf_md_list
 
 
@@ -100,24 +204,14 @@ def parse_tlt_file(tlt_file_name) -> Tuple[List[float], List[float], List[int]]:
     """Parse the IMOD tlt file, that can contain 1 column (tilt-angles), 2
     (tilt-angles and accumulated dose) or 3 (tilt-angles, accumulated dose and
     acquisition order)."""
-    angles: List[float] = []
-    doses: List[float] = []
-    orders: List[int] = []
-    with open(tlt_file_name) as f:
-        for line in f:
-            strippedLine = line.strip()
-            if not strippedLine:
-                print(f"Empty line found in {tlt_file_name}. Ignoring it.")
-                continue
-            columns = strippedLine.split()
-            if columns:
-                angles.append(float(columns[0]))
-                # If there is a second column, we take it as dose
-                if len(columns) > 1:
-                    doses.append(float(columns[1]))
-                # If there is a third column, we take it as tilt order
-                if len(columns) > 2:
-                    orders.append(int(columns[2]))
+    # Empty lines are skipped by loadtxt
+    tlt_data = np.loadtxt(tlt_file_name, dtype=np.float64, ndmin=2)
+    n_cols = tlt_data.shape[1]
+    angles: List[float] = tlt_data[:, 0].tolist()
+    # If there is a second column, we take it as dose
+    doses: List[float] = tlt_data[:, 1].tolist() if n_cols > 1 else []
+    # If there is a third column, we take it as tilt order
+    orders: List[int] = tlt_data[:, 2].astype(int).tolist() if n_cols > 2 else []
 
     print(f"Angles found: {angles}")
 
@@ -136,21 +230,16 @@ def parse_tlt_file(tlt_file_name) -> Tuple[List[float], List[float], List[int]]:
 
 def parse_xf_file(xf_file: Path) -> Tuple[np.ndarray, np.ndarray]:
     """This method takes an IMOD-based transformation matrix file (.xf) path and
-    returns a 2 x 2 x n and a 1 x 2 x n  matrices containing, respectively, the
-    rotation and translation matrices for each tilt-image belonging to the tilt-series."""
+    returns a n x 2 x 3 and a n x 3 matrices containing, respectively, the
+    rotation and translation matrices for each tilt-image belonging to the tilt-series.
+    Each line of the file contains the values A11 A12 A21 A22 DX DY of a tilt-image."""
 
-    matrix = np.loadtxt(xf_file, dtype=float, comments="#")
+    matrix = np.loadtxt(xf_file, dtype=float, comments="#", ndmin=2)
     n_lines = matrix.shape[0]
-    rotation_matrix = np.zeros([2, 3, n_lines])
-    translation_vector = np.zeros([3, n_lines])
-
-    for row in range(n_lines):
-        rotation_matrix[0, 0, row] = matrix[row][0]
-        rotation_matrix[1, 0, row] = matrix[row][2]
-        rotation_matrix[0, 1, row] = matrix[row][1]
-        rotation_matrix[1, 1, row] = matrix[row][3]
-        translation_vector[0, row] = matrix[row][4]
-        translation_vector[1, row] = matrix[row][5]
+    rotation_matrix = np.zeros([n_lines, 2, 3])
+    rotation_matrix[:, :, :2] = matrix[:, :4].reshape(n_lines, 2, 2)
+    translation_vector = np.zeros([n_lines, 3])
+    translation_vector[:, :2] = matrix[:, 4:6]
 
     return rotation_matrix, translation_vector
 
@@ -159,13 +248,12 @@ def get_acq_order_from_doses(dose_list: List[float]) -> List[int]:
     """Generate the acquisition order list of a tilt-series based on the provided
     dose_list, which may be unsorted.
     """
-    dose_list_sorted = np.argsort(dose_list)
-    acq_order_list = [0] * len(dose_list)
-    for i in range(len(dose_list)):
-        finalIndex = dose_list_sorted[i]
-        acq_order_list[finalIndex] = i + 1
-
-    return acq_order_list
+    # The acquisition order of each image is its rank in the sorted dose list. The
+    # stable sort keeps the file order for images with the same dose
+    dose_list_sorted = np.argsort(dose_list, kind="stable")
+    acq_order_list = np.empty(len(dose_list), dtype=int)
+    acq_order_list[dose_list_sorted] = np.arange(1, len(dose_list) + 1)
+    return acq_order_list.tolist()
 
 
 def write_tlt(
@@ -193,15 +281,16 @@ def write_tlt(
                 )
                 dose_list = []
 
-        # Write the file
+        # Write the file, with all the lines in a single write call
+        if dose_list:
+            tlt_text = "".join(
+                f"{angle:0.3f} {dose:0.4f}\n"
+                for angle, dose in zip(tilt_angles, dose_list)
+            )
+        else:
+            tlt_text = "".join(f"{angle:0.3f}\n" for angle in tilt_angles)
         with open(tlt_file, "w") as f:
-            if dose_list:
-                f.writelines(
-                    f"{angle:0.3f} {dose:0.4f}\n"
-                    for angle, dose in zip(tilt_angles, dose_list)
-                )
-            else:
-                f.writelines(f"{angle:0.3f}\n" for angle in tilt_angles)
+            f.write(tlt_text)
         print(f"tlt file successfully written! -> {tlt_file}")
     except Exception as e:
         print(
@@ -218,28 +307,28 @@ def write_xf(cets_ts_md: TiltSeries, xf_file: Path | str | None) -> None:
         xf_file = validate_new_file(xf_file)
         # Read the required data
         # pixel_size = cets_ts_md.images[0].pixel_size
-        transform_list = []
-        for ti in cets_ts_md.images:
-            translation = ti.coordinate_transformations[0].translation
-            rotation = ti.coordinate_transformations[1].affine
-            rot_matrix_elements = np.array(rotation).flatten()
-            # The shifts are stored in angstroms in CETS, but in pixels in IMOD
-            sx = translation[0]  # / pixel_size
-            sy = translation[1]  # / pixel_size
-            transform_list.append(
-                [
-                    f"{rot_matrix_elements[0]:.7f}",
-                    f"{rot_matrix_elements[1]:.7f}",
-                    f"{rot_matrix_elements[3]:.7f}",
-                    f"{rot_matrix_elements[4]:.7f}",
-                    f"{float(f'{sx:.3g}'):>6}",
-                    f"{float(f'{sy:.3g}'):>6}",
-                ]
-            )
-        # write the xf_file
+        images = cets_ts_md.images
+        n_imgs = len(images)
+        # A11 A12 A21 A22 of all the tilt-images, from their 3 x 3 affine matrices
+        rotation_pile = np.array(
+            [ti.coordinate_transformations[1].affine for ti in images],
+            dtype=np.float64,
+        ).reshape(n_imgs, 9)[:, [0, 1, 3, 4]]
+        # The shifts are stored in angstroms in CETS, but in pixels in IMOD
+        shift_pile = np.array(
+            [ti.coordinate_transformations[0].translation[:2] for ti in images],
+            dtype=np.float64,
+        ).reshape(n_imgs, 2)
+        # shift_pile /= pixel_size
+        transform_list = [
+            [f"{value:.7f}" for value in rot_values]
+            + [f"{float(f'{shift:.3g}'):>6}" for shift in shifts]
+            for rot_values, shifts in zip(rotation_pile.tolist(), shift_pile.tolist())
+        ]
+        # write the xf_file, with all the lines in a single write call
+        xf_text = "".join("\t".join(row) + "\n" for row in transform_list)
         with open(xf_file, "w") as f:
-            for row in transform_list:
-                f.write("\t".join(str(item) for item in row) + "\n")
+            f.write(xf_text)
         print(f"xf file successfully written! -> {xf_file}")
     except Exception as e:
         print(f"Unable to write the output xf file {xf_file} with the exception -> {e}")
@@ -271,23 +360,115 @@ def standarize_defocus(
     For more details see:
     http://i2pc.cnb.csic.es/emx/LoadDictionaryFormat.htm?type=Convention#ctf
     """
-    if defocus_v > defocus_u:
-        out_defocus_u = defocus_v  # exchange defocusU by defocusV
-        out_defocus_v = defocus_u
-        defocus_angle += 90.0
-    else:
-        out_defocus_u = defocus_u
-        out_defocus_v = defocus_v
-    if defocus_angle >= 180.0:
-        defocus_angle -= 180.0
-    elif defocus_angle < 0.0:
-        defocus_angle += 180.0
+    out_defocus_u, out_defocus_v, out_defocus_angle = standarize_defocus_batch(
+        np.array([defocus_u], dtype=np.float64),
+        np.array([defocus_v], dtype=np.float64),
+        np.array([defocus_angle], dtype=np.float64),
+    )
+    return (
+        float(out_defocus_u[0]),
+        float(out_defocus_v[0]),
+        float(out_defocus_angle[0]),
+    )
 
-    return out_defocus_u, out_defocus_v, defocus_angle
+
+def standarize_defocus_batch(
+    defocus_u: np.ndarray, defocus_v: np.ndarray, defocus_angle: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Vectorized version of standarize_defocus, which applies the same EMX
+    convention to the defocus values of all the tilt-images at once."""
+    swap = defocus_v > defocus_u  # exchange defocusU by defocusV
+    out_defocus_u = np.where(swap, defocus_v, defocus_u)
+    out_defocus_v = np.where(swap, defocus_u, defocus_v)
+    # Wrap the angle into [0, 180)
+    out_defocus_angle = np.mod(
+        np.where(swap, defocus_angle + 90.0, defocus_angle), 180.0
+    )
+    return out_defocus_u, out_defocus_v, out_defocus_angle
 
 
 # YAML STUFF ############################################################
 # TODO: if yaml is used, generalize it to any Pydantic ConfiguredBaseModel and move to the main repo
+# Use the libyaml-based (C) loader and dumper if PyYAML was built with it
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def yaml_float(value: float) -> str:
+    """Formats a float as the YAML safe dumper does, so it is loaded back as the same
+    float."""
+    if value != value:
+        return ".nan"
+    elif value == float("inf"):
+        return ".inf"
+    elif value == -float("inf"):
+        return "-.inf"
+    text = repr(value).lower()
+    # YAML 1.1 floats in exponential notation require a dot
+    if "." not in text and "e" in text:
+        text = text.replace("e", ".0e", 1)
+    return text
+
+
+def dump_md_dict(metadata_dict: Dict, f: IO[str], out_format: str = "yaml") -> None:
+    """Writes a serialized metadata object into an open file, in YAML or JSON format.
+    JSON is much faster to write and, as it is also valid YAML, it can be read back
+    with the YAML loader too. NaN and infinite values are rejected in JSON, as the
+    strict format has no representation for them."""
+    if out_format == "json":
+        json.dump(metadata_dict, f, indent=2, allow_nan=False)
+        f.write("\n")
+    else:
+        yaml.dump(
+            metadata_dict,
+            f,
+            Dumper=YamlDumper,
+            default_flow_style=False,
+            sort_keys=False,
+            explicit_start=True,
+        )
+
+
+@contextmanager
+def md_yaml_writer(yaml_file: Path | str) -> Iterator[IO[str]]:
+    """Opens a yaml file to write several metadata objects through a single buffered
+    stream, one YAML document per object. The stream is passed as out_yaml_file to
+    the imod_to_cets method of the tilt-series and tomogram converters.
+
+    :param yaml_file: name of the yaml file to be written.
+    :type yaml_file: pathlib.Path or str
+    """
+    yaml_file = validate_new_file(yaml_file)
+    with open(yaml_file, "w", buffering=1 << 20) as f:
+        yield f
+
+
+def validate_md_output(
+    out_md_file: Path | str | IO[str] | None, out_format: str
+) -> str:
+    """Validates the output metadata file format. Only yaml can be written to a
+    stream opened with md_yaml_writer, as the documents are appended to it."""
+    out_format = validate_md_file_format(out_format)
+    if out_format != "yaml" and not isinstance(out_md_file, (str, Path, type(None))):
+        raise ValueError("Only yaml metadata can be written to a yaml stream.")
+    return out_format
+
+
+def write_md_dict(
+    metadata_dict: Dict, out_md_file: Path | str | IO[str], out_format: str = "yaml"
+) -> str:
+    """Writes a serialized metadata object into a new file, or adds it to a stream
+    opened with md_yaml_writer, and returns the name of the file written."""
+    if isinstance(out_md_file, (str, Path)):
+        out_md_file = validate_new_file(out_md_file)
+        with open(out_md_file, "w") as f:
+            dump_md_dict(metadata_dict, f, out_format=out_format)
+        return str(out_md_file)
+    dump_md_dict(metadata_dict, out_md_file, out_format=out_format)
+    return getattr(out_md_file, "name", str(out_md_file))
+
+
+@lru_cache(maxsize=None)
 def _resolve_type(tp):
     """Helper to resolve type from Optional/Union as get_args(Optional[float]) returns (float, NoneType)
     as it is a shorthand for Union[float, None]"""
@@ -298,15 +479,29 @@ def _resolve_type(tp):
     return tp
 
 
+@lru_cache(maxsize=None)
 def _get_resolved_types(model_cls: type[BaseModel]) -> dict[str, type]:
     """Generates a dictionary from a Pydantic model where the keys are the field names
-    and the values are their corresponding data types."""
-    type_hints = get_type_hints(model_cls)
-    return {name: _resolve_type(tp) for name, tp in type_hints.items()}
-
-
-def _cast_value(value: str, target_type: type):
-    """Casting helper function."""
+    and the values are their corresponding data types. The field annotations were
+    already resolved by Pydantic when the model class was defined, so they are read
+    from model_fields instead of evaluated again with get_type_hints. The result is
+    cached per model class, so it must not be modified."""
+    return {
+        name: _resolve_type(field_info.annotation)
+        for name, field_info in model_cls.model_fields.items()
+    }
+
+
+def _cast_value(value, target_type):
+    """Casting helper function. Values that already are of the target type, or whose
+    target type is not a plain class (e.g. Any or a list of nested models), are
+    returned as they are."""
+    if (
+        target_type is Any
+        or not isinstance(target_type, type)
+        or isinstance(value, target_type)
+    ):
+        return value
     try:
         return target_type(value)
     except (ValueError, TypeError):
@@ -314,33 +509,25 @@ def _cast_value(value: str, target_type: type):
 
 
 def load_md_list_yaml(yaml_file: Path | str, model_cls: Type[BaseModel]) -> List[Dict]:
-    """Loads a .yaml file containing a list of"""
-    yaml_file = validate_file(yaml_file, "yaml_file", ".yaml")
-    with open(yaml_file, "r") as f:
-        lines = [line.strip() for line in f if line.strip()]
-
-    field_names = list(model_cls.model_fields.keys())
+    """Loads a .yaml file containing a list of serialized metadata objects of type
+    model_cls, one per YAML document, and returns them as dictionaries. A .json file
+    containing a single serialized object is also accepted."""
+    yaml_file = validate_file(yaml_file, "yaml_file", (".yaml", ".json"))
     resolved_types_dict = _get_resolved_types(model_cls)
-    metadata_list = []
-
-    token = ":"
-    section_len = len(field_names)
-    position = 0
-    while position < len(lines):
-        if token in lines[position]:
-            block = lines[position : position + section_len]
-            entry = {}
-            for line in block:
-                key, value = line.split(":")
-                key = key.strip()
-                value = value.strip()
-                target_type = resolved_types_dict.get(key, str)
-                entry[key] = _cast_value(value, target_type)
-            metadata_list.append(entry)
-            position += section_len
+    with open(yaml_file, "r") as f:
+        if yaml_file.suffix == ".json":
+            # A JSON file contains a single serialized object
+            docs = [json.load(f)]
         else:
-            position += 1
-    return metadata_list
+            docs = yaml.load_all(f, Loader=YamlLoader)
+        return [
+            {
+                key: _cast_value(value, resolved_types_dict.get(key, str))
+                for key, value in doc.items()
+            }
+            for doc in docs
+            if doc
+        ]
 
 
 # def load_md_list_yaml(yaml_file: Path | str, model_cls: Type[BaseModel]) -> List[Dict]: